@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""Scale benchmarks for scanning, preview, rename and rollback.
+
+Synthetic trees are generated in a temporary directory, every phase is
+timed on the same tree and throughput is reported in tree entries per
+second, so that numbers stay comparable when the number of underlying
+operations changes (e.g. when directories are renamed as a whole).  Some
+targets already exist, so renames overwrite files, move files into
+existing directories and, in the merge shape, merge whole directories
+into existing ones.
+
+    python3 bench.py --sizes 10000,100000 --save baseline.json
+    python3 bench.py --sizes 10000,100000 --compare baseline.json
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import rerename
+
+SHAPES = ('flat', 'deep', 'wide', 'merge')
+PHASES = ('scan', 'sample', 'preview', 'rollback', 'rename')
+SAMPLE_SIZE = 2000
+DEPTH = 20
+
+# every generated tree overwrites some files
+OPTIONS = rerename.DEFAULT_OPTIONS._replace(overwrite=True)
+
+def touch(path):
+    open(path, 'w').close()
+
+def generate_flat(root, size):
+    # every 100th file already exists under its new name
+    count = 0
+    idx = 0
+    while count < size:
+        touch(os.path.join(root, 'f%07d' % idx))
+        count += 1
+        if idx % 100 == 0 and count < size:
+            touch(os.path.join(root, 'g%07d' % idx))
+            count += 1
+        idx += 1
+    return r'^f(\d+)$', r'g\1', OPTIONS
+
+def generate_wide(root, size):
+    # files of every 10th directory move into an existing one, overwriting a file
+    per_dir = max(int(math.sqrt(size)), 1)
+    count = 0
+    idx = 0
+    while count < size:
+        path = os.path.join(root, 'd%05d' % idx)
+        os.mkdir(path)
+        count += 1
+        for file_idx in range(min(per_dir, size - count)):
+            touch(os.path.join(path, 'f%05d' % file_idx))
+            count += 1
+        if idx % 10 == 0 and count + 2 <= size:
+            path = os.path.join(root, 'e%05d' % idx)
+            os.mkdir(path)
+            touch(os.path.join(path, 'f%05d' % 0))
+            count += 2
+        idx += 1
+    return r'^d(\d+)/(.*)$', r'e\1/\2', OPTIONS
+
+def generate_deep(root, size):
+    # chains of DEPTH nested directories with a file on every level, files
+    # of every 10th chain move into an existing one, overwriting a file
+    count = 0
+    idx = 0
+    while count < size:
+        path = os.path.join(root, 'c%05d' % idx)
+        os.mkdir(path)
+        count += 1
+        for level in range(DEPTH):
+            if count + 2 > size:
+                break
+            path = os.path.join(path, 'l%02d' % level)
+            os.mkdir(path)
+            touch(os.path.join(path, 'f'))
+            count += 2
+        if idx % 10 == 0 and count + 3 <= size:
+            path = os.path.join(root, 'k%05d' % idx, 'l%02d' % 0)
+            os.makedirs(path)
+            touch(os.path.join(path, 'f'))
+            count += 3
+        idx += 1
+    return r'^c(\d+)/(.*)$', r'k\1/\2', OPTIONS
+
+def generate_merge(root, size):
+    # every directory is renamed onto an existing one, which holds one of
+    # its files and one of its own, and is moved in file by file
+    per_dir = max(int(math.sqrt(size)), 1)
+    count = 0
+    idx = 0
+    while count + 5 <= size:
+        path = os.path.join(root, 'd%05d' % idx)
+        os.mkdir(path)
+        count += 1
+        for file_idx in range(max(min(per_dir, size - count - 3), 1)):
+            touch(os.path.join(path, 'f%05d' % file_idx))
+            count += 1
+        path = os.path.join(root, 'e%05d' % idx)
+        os.mkdir(path)
+        touch(os.path.join(path, 'f%05d' % 0))
+        touch(os.path.join(path, 'keep'))
+        count += 3
+        idx += 1
+    return r'^d(\d+)$', r'e\1', OPTIONS._replace(files=False, dirs=True)
+
+GENERATORS = {
+    'flat': generate_flat,
+    'wide': generate_wide,
+    'deep': generate_deep,
+    'merge': generate_merge,
+}
+
+def measure(func, memory):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        res = func()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = None
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return res, seconds, peak
+
+def run_shape(shape, size, memory, tmpdir):
+    with tempfile.TemporaryDirectory(dir=tmpdir) as root:
+        regex, repl, options = GENERATORS[shape](root, size)
+        regex = re.compile(regex)
+        state = {}
+
+        def do_scan():
+            state['names'] = rerename.scan(root, True)
+
+        def do_sample():
+            # includes building the type lookup, done once per scan in the GUI
+            rerename.estimate_preview(root, state['names'], True, regex, repl, options,
+                                      SAMPLE_SIZE, dict(state['names']))
+
+        def do_preview():
+            state['preview'] = rerename.compute_preview(
+                root, state['names'], True, regex, repl, options)
+            if state['preview'].errors:
+                raise RuntimeError('\n'.join(state['preview'].errors[:20]))
+
+        def do_rollback():
+            mapping = state['preview'].mapping + [('missing', 'irrelevant')]
+            try:
+                rerename.rename(root, mapping, options.overwrite, options.create_missing, options.delete_empty)
+            except FileNotFoundError:
+                pass
+            else:
+                raise RuntimeError('rename did not fail')
+
+        def do_rename():
+            rerename.rename(root, state['preview'].mapping,
+                            options.overwrite, options.create_missing, options.delete_empty)
+
+        phases = dict(scan=do_scan, sample=do_sample, preview=do_preview,
+                      rollback=do_rollback, rename=do_rename)
+        for phase in PHASES:
+            _, seconds, peak = measure(phases[phase], memory)
+            entries = len(state['names'])
+            yield dict(
+                shape=shape, size=size, phase=phase,
+                seconds=seconds,
+                ops_per_sec=entries / seconds if seconds else None,
+                peak_bytes=peak,
+            )
+
+def key(result):
+    return result['shape'], result['size'], result['phase']
+
+def format_result(result, baseline=None, tolerance=None):
+    peak = result['peak_bytes']
+    line = '%-5s %8d %-9s %9.3fs %12.0f ops/s %10s' % (
+        result['shape'], result['size'], result['phase'],
+        result['seconds'], result['ops_per_sec'] or 0,
+        '-' if peak is None else '%.1f MiB' % (peak / 2**20),
+    )
+    regression = False
+    if baseline is not None:
+        ratio = result['seconds'] / max(baseline['seconds'], 1e-9)
+        regression = ratio > 1 + tolerance
+        line += '  %5.2fx baseline%s' % (ratio, '  REGRESSION' if regression else '')
+    return line, regression
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated tree sizes (default: %(default)s)')
+    parser.add_argument('--shapes', default=','.join(SHAPES),
+                        help='comma separated tree shapes (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace peak memory, it slows down every phase')
+    parser.add_argument('--tmpdir', help='where to generate trees')
+    parser.add_argument('--save', metavar='PATH', help='store results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare results against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    shapes = args.shapes.split(',')
+    for shape in shapes:
+        if shape not in GENERATORS:
+            parser.error('unknown shape: %s' % shape)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = dict((key(result), result) for result in json.load(f)['results'])
+
+    results = []
+    regressions = 0
+    for size in sizes:
+        for shape in shapes:
+            for result in run_shape(shape, size, not args.no_memory, args.tmpdir):
+                results.append(result)
+                line, regression = format_result(result, baseline.get(key(result)), args.tolerance)
+                regressions += regression
+                print(line, flush=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict(results=results), f, indent=2)
+
+    if regressions:
+        print('%d regression(s) against %s' % (regressions, args.compare))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,33 @@
 import os
 import os.path
 import re
-from collections import namedtuple
+from collections import namedtuple, Counter
+from contextlib import contextmanager
 import traceback
 import time
 import hashlib
 import sys
 import shutil
+import threading
+import queue
+import json
+import io
+import cProfile
+import pstats
+import socket
+import socketserver
+import stat
+import argparse
+import itertools
+import builtins
+import random
+import bisect
 
 from tkinter import Tk, Label, Button, Entry, Frame, Listbox, StringVar, Grid, Scrollbar, BooleanVar, Checkbutton
-from tkinter import LEFT, RIGHT, BOTH, X, Y, END, VERTICAL, RIDGE
+from tkinter import LEFT, RIGHT, BOTH, X, Y, END, VERTICAL, RIDGE, DISABLED, NORMAL, SUNKEN
+from tkinter.ttk import Progressbar
 from tkinter.filedialog import askdirectory
-from tkinter.messagebox import showerror
+from tkinter.messagebox import showerror, showinfo
 
 def repad(widget, attr, margin, spacing, attr2=None, margin2=None):
     if attr2:
@@ -154,6 +170,12 @@ class RegexFrame(Frame):
 
 Options = namedtuple('Options', 'files dirs others hide_wrong_type hide_mismatches overwrite create_missing delete_empty')
 
+DEFAULT_OPTIONS = Options(
+    files=True, dirs=False, others=False,
+    hide_wrong_type=False, hide_mismatches=False,
+    overwrite=False, create_missing=True, delete_empty=False,
+)
+
 
 class OptionsFrame(Frame):
     def __init__(self, master):
@@ -161,7 +183,7 @@ class OptionsFrame(Frame):
 
         self._vars = {}
 
-        self._add_option('files', 'Files', True)
+        self._add_option('files', 'Files')
         self._add_option('dirs', 'Dirs')
         self._add_option('others', 'Others')
 
@@ -173,16 +195,16 @@ class OptionsFrame(Frame):
         Separator(self).pack(side=LEFT, fill=Y)
 
         self._add_option('overwrite', 'Overwrite')
-        self._add_option('create_missing', 'Create missing dirs', True)
+        self._add_option('create_missing', 'Create missing dirs')
         self._add_option('delete_empty', 'Delete empty dirs')
 
         repad(self, 'padx', 0, 5)
 
-    def _add_option(self, name, description, value=False):
+    def _add_option(self, name, description):
         var = BooleanVar()
         self._vars[name] = var
         
-        var.set(value)
+        var.set(getattr(DEFAULT_OPTIONS, name))
         var.trace('w', self._options_update)
 
         cb = Checkbutton(self, text=description, variable=var)
@@ -199,11 +221,315 @@ class OptionsFrame(Frame):
         return Options(**values)
         
 
+# only one profiler can be enabled at a time since Python 3.12
+_profile_lock = threading.Lock()
+
+class Instrumentation(object):
+    """Per-phase wall time and operation counts, optionally with cProfile.
+
+    Phases with the same name add up, nested phases are timed on their
+    own but profiled as a part of the outermost one.  A phase that starts
+    while another thread is profiling is timed, but not profiled.
+    """
+
+    def __init__(self, profile=False):
+        self.phases = {}
+        self.counts = Counter()
+        self._profiler = cProfile.Profile() if profile else None
+        self._profiled = False
+        self._depth = 0
+
+    @contextmanager
+    def phase(self, name):
+        profiling = False
+        if self._profiler and not self._depth and _profile_lock.acquire(blocking=False):
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # a profiler outside of rerename is active
+                _profile_lock.release()
+            else:
+                profiling = self._profiled = True
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            self._depth -= 1
+            if profiling:
+                self._profiler.disable()
+                _profile_lock.release()
+
+    def count(self, op, n=1):
+        self.counts[op] += n
+
+    def report(self):
+        res = dict(phases=dict(self.phases), counts=dict(self.counts))
+        if self._profiled:
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(30)
+            res['profile'] = stream.getvalue()
+        return res
+
+    def json(self):
+        return json.dumps(self.report(), indent=2)
+
+    @classmethod
+    def from_report(cls, report):
+        instr = cls()
+        instr.phases.update(report['phases'])
+        instr.counts.update(report['counts'])
+        return instr
+
+    def summary(self):
+        phases = ', '.join('%s %.2fs' % item for item in self.phases.items())
+        counts = ', '.join('%d %s' % (n, op) for op, n in sorted(self.counts.items()))
+        return ' | '.join(part for part in (phases, counts) if part)
+
+
+def _walk(root_path, instr):
+    for root, dirs, files in os.walk(root_path):
+        instr.count('listdir')
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, root_path)
+
+def _ftype(path):
+    if os.path.isfile(path):
+        return True
+    if os.path.isdir(path):
+        return False
+    return None
+
+def scan(root, recursive, instr=None):
+    """Return sorted (name, ftype) pairs for the entries of root.
+
+    ftype is True for files, False for directories and None otherwise.
+    """
+    instr = instr or Instrumentation()
+    with instr.phase('scan'):
+        if recursive:
+            entries = _walk(root, instr)
+        else:
+            instr.count('listdir')
+            entries = os.listdir(root)
+
+        names = [(name, _ftype(os.path.join(root, name))) for name in sorted(entries)]
+        instr.count('stat', 2 * len(names))
+    return names
+
+def _rescan(root, names, recursive, changed, instr=None):
+    """Return sorted names of scan() with the changed entries scanned again.
+
+    changed are names relative to root whose whole subtree may differ from
+    names, their parent directories may have been created or removed.
+    Everything else is taken from names.
+    """
+    instr = instr or Instrumentation()
+    with instr.phase('rescan'):
+        subtrees = set()
+        for name in changed:
+            name = os.path.normpath(name)
+            subtrees.add(name if recursive else name.split(os.sep)[0])
+        # a subtree within another one is scanned with it
+        subtrees = set(name for name in subtrees
+                       if not any(name.startswith(other + os.sep) for other in subtrees))
+        parents = set()
+        for name in subtrees:
+            parent = os.path.dirname(name)
+            while parent and parent not in subtrees:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+
+        # names are sorted, so every entry and its subtree are a slice of them
+        drop = []
+        for name in subtrees | parents:
+            drop.append((bisect.bisect_left(names, (name,)), bisect.bisect_left(names, (name + '\0',))))
+        for name in subtrees:
+            drop.append((bisect.bisect_left(names, (name + os.sep,)),
+                         bisect.bisect_left(names, (name + chr(ord(os.sep) + 1),))))
+        res = []
+        start = 0
+        for lo, hi in sorted(drop):
+            res.extend(names[start:max(lo, start)])
+            start = max(hi, start)
+        res.extend(names[start:])
+
+        for name in subtrees | parents:
+            path = os.path.join(root, name)
+            instr.count('stat', 2)
+            if os.path.lexists(path):
+                ftype = _ftype(path)
+                res.append((name, ftype))
+                if recursive and ftype is False and name in subtrees:
+                    res.extend((os.path.join(name, sub), sub_ftype)
+                               for sub, sub_ftype in scan(path, True, instr))
+        res.sort(key=lambda entry: entry[0])
+    return res
+
+
+Row = namedtuple('Row', 'left right left_color right_color')
+Preview = namedtuple('Preview', 'rows mapping errors matches conflicts exact')
+
+def _is_type_enabled(options, ftype):
+    if ftype is True:
+        return options.files
+    elif ftype is False:
+        return options.dirs
+    else:
+        return options.others
+
+def compute_preview(root, names, recursive, regex, repl, options, instr=None):
+    """Compute list rows, the mapping to execute and errors for scanned names."""
+    instr = instr or Instrumentation()
+    rows = []
+    mapping = []
+    errors = []
+    sources = {}
+
+    if not repl:
+        errors.append('Invalid replacement string')
+
+    with instr.phase('regex'):
+        matches = _match_names(names, regex, repl, options, rows, mapping, sources)
+
+    with instr.phase('collapse'):
+        mapping = collapse_mapping(names, mapping, options.create_missing)
+    with instr.phase('validate'):
+        conflicts = validate_mapping(root, names, mapping, recursive,
+                                     options.overwrite, options.create_missing, instr)
+    _mark_conflicts(conflicts, rows, errors, sources)
+
+    return Preview(rows, mapping, errors, matches, len(conflicts), True)
+
+def estimate_preview(root, names, recursive, regex, repl, options, size, types=None, instr=None, block=8):
+    """Preview a stratified sample of names with counts scaled to all of them.
+
+    names are split into size / block consecutive strata of equal length
+    and a run of block consecutive entries, starting at a random entry and
+    wrapping around within the stratum, is previewed from each.  So every
+    part of the sorted tree is represented, every entry is sampled with the
+    same chance and collisions between neighbouring names are found.  The
+    choice only depends on the number of names, so the sample stays the
+    same while the regex is edited.  A conflict is scaled by the inverse of
+    the chance that the runs it was found in cover all of its sources.
+    types maps every name to its ftype, it lets the sample be checked
+    against existing targets that were not sampled.  Falls back to
+    compute_preview() when there are no more than size names.
+    """
+    if len(names) <= size:
+        return compute_preview(root, names, recursive, regex, repl, options, instr)
+
+    instr = instr or Instrumentation()
+    block = min(block, size)
+    runs = max(size // block, 1)
+    rand = random.Random(len(names))
+    sample = []
+    strata = []
+    positions = {}
+    for idx in range(runs):
+        first, end = idx * len(names) // runs, (idx + 1) * len(names) // runs
+        strata.append((first, end))
+        start = rand.randrange(end - first)
+        for pos in sorted(first + (start + offset) % (end - first) for offset in range(block)):
+            sample.append(names[pos])
+            positions[names[pos][0]] = idx, pos
+    scale = len(names) / len(sample)
+    rows = []
+    mapping = []
+    errors = []
+    sources = {}
+
+    if not repl:
+        errors.append('Invalid replacement string')
+
+    with instr.phase('regex'):
+        matches = _match_names(sample, regex, repl, options, rows, mapping, sources)
+
+    with instr.phase('validate'):
+        model_names = list(sample)
+        if types is not None:
+            for _, name_to in mapping:
+                if name_to in types and name_to not in positions:
+                    model_names.append((name_to, types[name_to]))
+        conflicts = validate_mapping(root, model_names, mapping, recursive,
+                                     options.overwrite, options.create_missing, instr)
+    _mark_conflicts(conflicts, rows, errors, sources)
+
+    estimated = 0
+    for conflict in conflicts:
+        groups = {}
+        weight = 1
+        for name in conflict.sources:
+            if name in positions:
+                idx, pos = positions[name]
+                groups.setdefault(idx, set()).add(pos)
+            else:
+                weight *= scale
+        for idx, group in groups.items():
+            # a run covers the group if it fits between the ends of any
+            # of the gaps between its sources, around the stratum
+            first, end = strata[idx]
+            length = end - first
+            group = sorted(group)
+            gaps = [group[0] + length - group[-1]] + [b - a for a, b in zip(group, group[1:])]
+            weight *= length / sum(max(0, block - length + gap) for gap in gaps)
+        estimated += weight
+    return Preview(rows, mapping, errors, round(matches * scale), round(estimated), False)
+
+def _mark_conflicts(conflicts, rows, errors, sources):
+    marked = set()
+    dirs = set()
+    for conflict in conflicts:
+        errors.append(conflict.message)
+        for name in conflict.sources:
+            if name in sources:
+                marked.add(sources[name])
+            else:
+                # a collapsed directory, its rows are the entries below it
+                dirs.add(name)
+    if dirs:
+        for name, idx in sources.items():
+            parent = os.path.dirname(name)
+            while parent:
+                if parent in dirs:
+                    marked.add(idx)
+                    break
+                parent = os.path.dirname(parent)
+    for idx in marked:
+        rows[idx] = rows[idx]._replace(right_color='red')
+
+def _match_names(names, regex, repl, options, rows, mapping, sources):
+    matches = 0
+    for name, ftype in names:
+        enabled = _is_type_enabled(options, ftype)
+        if enabled or not options.hide_wrong_type:
+            if not enabled or not regex:
+                rows.append(Row(name, name, 'gray', 'gray'))
+            elif regex and not regex.match(name):
+                if not options.hide_mismatches:
+                    rows.append(Row(name, name, 'gray', 'gray'))
+            elif not repl:
+                rows.append(Row(name, name, None, 'gray'))
+            else:
+                right_name = regex.sub(repl, name)
+                if name != right_name:
+                    mapping.append((name, right_name))
+                    sources[name] = len(rows)
+                rows.append(Row(name, right_name, None, None))
+                matches += 1
+    return matches
+
+
 class ListFrame(Frame):
+    sample_size = 2000
+    poll_interval = 50
+
     def __init__(self, master,
                  root, recursive,
                  regex, repl,
-                 options):
+                 options, backend):
         Frame.__init__(self, master)
 
         self._left_list = Listbox(self)
@@ -223,17 +549,25 @@ class ListFrame(Frame):
         self._regex = regex
         self._repl = repl
         self._settings = options
+        self._backend = backend
         self._root = None
         self._recursive = None
-        self._names = None
         self._mapping = None
         self._errors = None
+        self._scan_instr = None
+        self._preview_instr = None
+        self._preview = None
+        self._generation = 0
+        self._pending = None
+        self._evaluating = None
+        self._failure = None
         self._update_root(root, recursive)
 
         master.bind('<<RootUpdate>>', self._on_root_update)
         master.bind('<<RegexUpdate>>', self._on_regex_update)
         master.bind('<<OptionsUpdate>>', self._on_options_update)
         master.bind('<<Refresh>>', self._on_refresh)
+        master.bind('<<Renamed>>', self._on_renamed)
 
     def _scroll_left(self, sfrom, sto):
         self._scrollbar.set(sfrom, sto)
@@ -254,6 +588,9 @@ class ListFrame(Frame):
         self._update_regex(event.widget.regex, event.widget.repl)
 
     def _on_refresh(self, event):
+        self._update_root(self._root, self._recursive, refresh=True)
+
+    def _on_renamed(self, event):
         self._update_root(self._root, self._recursive)
 
     def _on_options_update(self, event):
@@ -265,118 +602,466 @@ class ListFrame(Frame):
         self._repl = repl
         self._update_lists()
 
-    def _is_type_enabled(self, ftype):
-        if ftype is True:
-            return self._settings.files
-        elif ftype is False:
-            return self._settings.dirs
+    def _update_root(self, root, recursive, refresh=False):
+        self._root = root
+        self._recursive = recursive
+        self._scan_instr = self._backend.scan(root, recursive, refresh)
+        self._update_lists()
+
+    def _update_lists(self):
+        # a sample is shown right away, the full preview of large trees is
+        # computed in a worker thread, one at a time, and only the result
+        # for the latest settings is shown
+        self._generation += 1
+        self._failure = None
+        args = (self._root, self._recursive, self._regex, self._repl, self._settings)
+        preview, instr = self._backend.preview(*args, sample=self.sample_size)
+        self._show_preview(preview, instr)
+        if preview.exact:
+            self._pending = None
         else:
-            return self._settings.others
+            self._pending = self._generation, args
+            if self._evaluating is None:
+                self._start_evaluation()
 
-    def _walk(self):
-        for root, dirs, files in os.walk(self._root):
-            for name in files + dirs:
-                path = os.path.join(root, name)
-                yield os.path.relpath(path, self._root)
+    def _start_evaluation(self):
+        (generation, args), self._pending = self._pending, None
+        results = queue.Queue()
+        backend = self._backend
 
-    def _entries(self):
-        if self._recursive:
-            return self._walk()
-        else:
-            return os.listdir(self._root)
+        def evaluate():
+            try:
+                results.put((backend.preview(*args), None))
+            except Exception as e:
+                results.put((None, e))
 
-    def _update_root(self, root, recursive):
-        self._root = root
-        self._recursive = recursive
-        self._left_list.delete(0, END)
-        self._names = []
-        if self._root:
-            for name in sorted(self._entries()):
-                path = os.path.join(self._root, name)
-                ftype = None
-                if os.path.isfile(path):
-                    ftype = True
-                if os.path.isdir(path):
-                    ftype = False
-                self._names.append((name, ftype))
+        threading.Thread(target=evaluate, daemon=True).start()
+        self._evaluating = generation, results
+        self.after(self.poll_interval, self._poll_evaluation)
 
-        self._update_lists()
+    def _poll_evaluation(self):
+        generation, results = self._evaluating
+        try:
+            result, error = results.get_nowait()
+        except queue.Empty:
+            self.after(self.poll_interval, self._poll_evaluation)
+            return
+
+        self._evaluating = None
+        if self._pending is not None:
+            self._start_evaluation()
+        if generation == self._generation:
+            if error is not None:
+                # the sample stays on screen, Rename stays disabled
+                self._failure = error
+                self.event_generate('<<PreviewUpdate>>', when='tail')
+                raise error
+            self._show_preview(*result)
+
+    def _show_preview(self, preview, instr):
+        self._preview = preview
+        self._mapping = preview.mapping
+        self._errors = preview.errors
+
+        with instr.phase('lists'):
+            self._left_list.delete(0, END)
+            self._right_list.delete(0, END)
+            self._left_list.insert(END, *(row.left for row in preview.rows))
+            self._right_list.insert(END, *(row.right for row in preview.rows))
+            for idx, row in enumerate(preview.rows):
+                if row.left_color:
+                    self._left_list.itemconfig(idx, dict(fg=row.left_color))
+                if row.right_color:
+                    self._right_list.itemconfig(idx, dict(fg=row.right_color))
+
+        self._preview_instr = instr
+        self.event_generate('<<StatsUpdate>>', when='tail')
+        self.event_generate('<<PreviewUpdate>>', when='tail')
 
-    def _insert_name_both(self, name, color, color_right_only=False):
-        idx = self._left_list.size()
-        self._left_list.insert(END, name)
-        if not color_right_only:
-            self._left_list.itemconfig(idx, dict(fg=color))
-        self._right_list.insert(END, name)
-        self._right_list.itemconfig(idx, dict(fg=color))
+    @property
+    def exact(self):
+        return self._preview.exact
 
-    def _update_lists(self):
-        self._mapping = []
-        self._errors = []
-        rev_mapping = {}
-        self._left_list.delete(0, END)
-        self._right_list.delete(0, END)
-
-        if not self._repl:
-            self._errors.append('Invalid replacement string')
-        
-        for name, ftype in self._names:
-            enabled = self._is_type_enabled(ftype)
-            if enabled or not self._settings.hide_wrong_type:
-                if not enabled or not self._regex:
-                    self._insert_name_both(name, 'gray')
-                elif self._regex and not self._regex.match(name):
-                    if not self._settings.hide_mismatches:
-                        self._insert_name_both(name, 'gray')
-                elif not self._repl:
-                    self._insert_name_both(name, 'gray', color_right_only=True)
-                else:
-                    idx = self._left_list.size()
-                    right_name = self._regex.sub(self._repl, name)
-                    self._left_list.insert(END, name)
-                    self._right_list.insert(END, right_name)
-
-                    if name != right_name:
-                        self._mapping.append((name, right_name))
-
-                        right_path = os.path.join(self._root, right_name)
-                        if os.path.exists(right_path):
-                            error = 'File already exists: %s' % right_name
-                        elif right_name in rev_mapping:
-                            other_name, other_idx = rev_mapping[right_name]
-                            colliding_sources = name, other_name
-                            error = 'Name collision: %s <- %s | %s' % (right_name, *colliding_sources)
-                            self._right_list.itemconfig(other_idx, dict(fg='red'))
-                        else:
-                            error = None
-                            rev_mapping[right_name] = name, idx
-
-                        if error:
-                            self._errors.append(error)
-                            self._right_list.itemconfig(idx, dict(fg='red'))
+    @property
+    def summary(self):
+        preview = self._preview
+        if preview.exact:
+            return 'Matches: %d, conflicts: %d' % (preview.matches, preview.conflicts)
+        if self._failure is not None:
+            return 'Matches: ~%d, conflicts: ~%d (estimated, full preview failed: %s)' % (
+                preview.matches, preview.conflicts, self._failure)
+        return 'Matches: ~%d, conflicts: ~%d (estimated, evaluating all entries...)' % (
+            preview.matches, preview.conflicts)
 
     @property
     def mapping(self):
-        if not self._errors:
+        if not self._errors and self._preview.exact:
             return self._mapping
 
     @property
     def errors(self):
         return self._errors
 
+    @property
+    def instrumentation(self):
+        return self._scan_instr, self._preview_instr
+
+class ProgressFrame(Frame):
+    poll_interval = 50
+
+    def __init__(self, master):
+        Frame.__init__(self, master)
+
+        self._bar = Progressbar(self, mode='determinate')
+        self._bar.pack(side=LEFT, fill=X, expand=True)
+
+        self._label = Label(self, width=40, anchor='w')
+        self._label.pack(side=LEFT)
+
+        self._cancel_button = Button(self, text='Cancel', command=self.cancel, state=DISABLED)
+        self._cancel_button.pack(side=LEFT)
+
+        repad(self, 'padx', 0, 5)
+
+        self._queue = None
+        self._cancel = None
+        self._callback = None
+
+    @property
+    def running(self):
+        return self._queue is not None
+
+    def run(self, func, callback):
+        # func(progress, cancel) runs in a worker thread, Tk is only touched
+        # from _poll, callback(result, error) is called once func is finished
+        self._queue = queue.Queue()
+        self._cancel = threading.Event()
+        self._callback = callback
+        self._bar.config(value=0, maximum=1)
+        self._label.config(text='Starting...')
+        self._cancel_button.config(state=NORMAL)
+        threading.Thread(target=self._work, args=(func, self._queue, self._cancel), daemon=True).start()
+        self.after(self.poll_interval, self._poll)
+
+    def cancel(self):
+        if self.running:
+            self._cancel.set()
+            self._cancel_button.config(state=DISABLED)
+            self._label.config(text='Cancelling...')
+
+    @staticmethod
+    def _work(func, results, cancel):
+        try:
+            result = func(lambda progress: results.put((progress, None)), cancel)
+        except BaseException as e:
+            results.put((None, (None, e)))
+        else:
+            results.put((None, (result, None)))
+
+    @staticmethod
+    def _format_time(seconds):
+        if seconds is None:
+            return '?'
+        minutes, seconds = divmod(int(seconds), 60)
+        return '%d:%02d' % (minutes, seconds)
+
+    def _poll(self):
+        last_progress = None
+        while True:
+            try:
+                progress, outcome = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if progress is None:
+                callback = self._callback
+                self._queue = None
+                self._cancel = None
+                self._callback = None
+                self._cancel_button.config(state=DISABLED)
+                self._label.config(text='')
+                callback(*outcome)
+                return
+            last_progress = progress
+
+        if last_progress and not self._cancel.is_set():
+            self._bar.config(value=last_progress.done, maximum=max(last_progress.total, 1))
+            self._label.config(text='%d/%d, %.0f ops/s, ETA %s' % (
+                last_progress.done, last_progress.total,
+                last_progress.rate, self._format_time(last_progress.eta)))
+        self.after(self.poll_interval, self._poll)
+
+
+def collapse_mapping(names, mapping, create_missing):
+    """Replace per-entry mappings covering a whole directory with one rename.
+
+    A directory is collapsed when every scanned entry below it is mapped
+    with the same prefix change, nothing else is moved into it and its
+    new location does not exist yet.  Only the outermost such directory is
+    kept, entries of partially affected subtrees are left as they are.
+    """
+    mapping = list(mapping)
+    if not create_missing:
+        # without create_missing per-entry renames into a missing
+        # directory fail, a directory rename would not
+        return mapping
+
+    targets = dict(mapping)
+    destinations = set(targets.values())
+    existing = set()
+    children = {}
+    for name, _ in names:
+        existing.add(name)
+        children.setdefault(os.path.dirname(name), []).append(name)
+
+    receiving = set()
+    for name_to in destinations:
+        while name_to and name_to not in receiving:
+            receiving.add(name_to)
+            name_to = os.path.dirname(name_to)
+
+    moved = {}
+    claimed = set()
+    for name in sorted(existing, key=lambda name: (-name.count(os.sep), name)):
+        subs = children.get(name)
+        if subs is None:
+            if name in targets:
+                moved[name] = targets[name]
+            continue
+
+        parents = set()
+        for sub in subs:
+            sub_to = moved.get(sub)
+            if sub_to is None or os.path.basename(sub_to) != os.path.basename(sub):
+                break
+            parents.add(os.path.dirname(sub_to))
+        else:
+            if len(parents) != 1:
+                continue
+            name_to, = parents
+            if (name_to and targets.get(name, name_to) == name_to
+                    and name not in receiving
+                    and name_to not in existing
+                    and (name_to == targets.get(name) or name_to not in destinations)
+                    and name_to not in claimed
+                    and not name_to.startswith(name + os.sep)):
+                # two directories merging into one new directory can't
+                # both be renamed to it, the later ones stay per-entry
+                moved[name] = name_to
+                claimed.add(name_to)
+
+    collapsed = []
+    emitted = set()
+    for name_from, name_to in mapping:
+        top = None
+        parent = name_from
+        while parent:
+            if parent in children and parent in moved:
+                top = parent
+            parent = os.path.dirname(parent)
+        if top is None:
+            collapsed.append((name_from, name_to))
+        elif top not in emitted:
+            emitted.add(top)
+            collapsed.append((top, moved[top]))
+    return collapsed
+
+Conflict = namedtuple('Conflict', 'sources message')
+
+_MISSING = object()
+
+
+class _ModelDir(dict):
+    def __init__(self, path=None):
+        dict.__init__(self)
+        self._path = path
+
+    @property
+    def listed(self):
+        return self._path is None
+
+    def load(self):
+        # directories outside of the scan are listed once, on first access
+        if self._path is not None:
+            path, self._path = self._path, None
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                entries = []
+            for entry in entries:
+                if entry.is_dir():
+                    self[entry.name] = _ModelDir(entry.path)
+                else:
+                    self[entry.name] = entry.is_file() or None
+        return self
+
+
+class TreeModel(object):
+    """In-memory model of the tree under root built from a scan.
+
+    Directories are dicts of their entries, files are True and other
+    entries None.  When the scan was not recursive the contents of
+    subdirectories are listed lazily when the plan needs them.
+    """
+
+    def __init__(self, root, names, recursive, instr=None):
+        self._instr = instr or Instrumentation()
+        self._tree = _ModelDir()
+        for name, ftype in names:
+            parts = self._split(name)
+            node = self._tree
+            for part in parts[:-1]:
+                node = node.setdefault(part, _ModelDir())
+            if ftype is False:
+                path = None if recursive else os.path.join(root, name)
+                node.setdefault(parts[-1], _ModelDir(path))
+            else:
+                node[parts[-1]] = ftype
+
+    @staticmethod
+    def _split(name):
+        if os.altsep:
+            name = name.replace(os.altsep, os.sep)
+        return [part for part in name.split(os.sep) if part]
+
+    def _load(self, node):
+        if not node.listed:
+            self._instr.count('listdir')
+        return node.load()
+
+    def _get(self, parts):
+        node = self._tree
+        for part in parts:
+            if not isinstance(node, _ModelDir):
+                return _MISSING
+            node = self._load(node).get(part, _MISSING)
+            if node is _MISSING:
+                break
+        return node
+
+    def _make_parent(self, parts, create_missing):
+        node = self._tree
+        for idx, part in enumerate(parts[:-1]):
+            child = self._load(node).get(part, _MISSING)
+            if child is _MISSING:
+                if not create_missing:
+                    return 'Missing directory: %s' % os.path.join(*parts[:idx+1])
+                child = node[part] = _ModelDir()
+            elif not isinstance(child, _ModelDir):
+                return 'Not a directory: %s' % os.path.join(*parts[:idx+1])
+            node = child
+        return self._load(node)
+
+    def _move(self, parts_from, parent_to, parts_to):
+        node = self._get(parts_from[:-1]).pop(parts_from[-1])
+        parent_to[parts_to[-1]] = node
+
+    def simulate(self, mapping, overwrite, create_missing):
+        """Apply mapping to the model the way Renamer applies it to disk.
+
+        Returns a list of Conflict for every operation Renamer would fail
+        on, failed operations are skipped and the simulation goes on.
+        """
+        conflicts = []
+        self._simulate(mapping, overwrite, create_missing, {}, conflicts)
+        return conflicts
+
+    def _simulate(self, mapping, overwrite, create_missing, destinations, conflicts):
+        for name_from, name_to in mapping:
+            def conflict(message, *sources):
+                conflicts.append(Conflict((name_from,) + sources, message))
+
+            parts_from = self._split(name_from)
+            parts_to = self._split(name_to)
+            node = self._get(parts_from)
+
+            dir_mapping = Renamer._ends_with_slash(name_from) or Renamer._ends_with_slash(name_to)
+            if dir_mapping and node is _MISSING:
+                conflict('No such file: %s' % name_from)
+                continue
+            if dir_mapping and not isinstance(node, _ModelDir):
+                conflict('Not a directory: %s' % name_from)
+                continue
+
+            if parts_from == parts_to:
+                continue
+
+            if not name_to:
+                conflict('Empty target name: %s' % name_from)
+                continue
+            if name_to in destinations:
+                other_name = destinations[name_to]
+                conflict('Name collision: %s <- %s | %s' % (name_to, name_from, other_name), other_name)
+                continue
+            destinations[name_to] = name_from
+
+            if node is _MISSING:
+                conflict('No such file: %s' % name_from)
+                continue
+            if parts_to[:len(parts_from)] == parts_from:
+                conflict('Cannot move into itself: %s <- %s' % (name_to, name_from))
+                continue
+
+            target = self._get(parts_to)
+            if target is _MISSING:
+                parent = self._make_parent(parts_to, create_missing)
+                if isinstance(parent, str):
+                    conflict(parent)
+                else:
+                    self._move(parts_from, parent, parts_to)
+            elif isinstance(node, _ModelDir):
+                if not isinstance(target, _ModelDir):
+                    conflict('Not a directory: %s' % name_to)
+                    continue
+                sub_mapping = [(os.path.join(name_from, name), os.path.join(name_to, name)) for name in list(self._load(node))]
+                self._simulate(sub_mapping, overwrite, create_missing, destinations, conflicts)
+                self._get(parts_from[:-1]).pop(parts_from[-1])
+            elif not overwrite:
+                conflict('File already exists: %s' % name_to)
+            elif isinstance(target, _ModelDir):
+                conflict('Is a directory: %s' % name_to)
+            else:
+                self._move(parts_from, self._get(parts_to[:-1]), parts_to)
+
+def validate_mapping(root, names, mapping, recursive, overwrite=False, create_missing=False, instr=None):
+    """Return every Conflict rename() would run into, without touching the disk."""
+    return TreeModel(root, names, recursive, instr).simulate(mapping, overwrite, create_missing)
+
 def md5(val):
     m = hashlib.md5()
     m.update(val.encode('utf8'))
     return m.hexdigest()
 
+class RenameCancelled(Exception):
+    pass
+
+Progress = namedtuple('Progress', 'done total rate eta')
+
 class Renamer(object):
 
-    def __init__(self, root):
+    # progress is reported in mapping entries, at start, at the end and at
+    # most every progress_interval seconds in between; an entry merged into
+    # an existing directory advances fractionally as its contents are moved
+    progress_interval = 0.1
+
+    def __init__(self, root, progress=None, cancel=None, instr=None):
         self._root = root
+        self._progress = progress
+        self._cancel = cancel
+        self._instr = instr or Instrumentation()
         self._renamed = None
         self._temp = None
+        self._position = None
+
+    def _exists(self, path):
+        self._instr.count('stat')
+        return os.path.exists(path)
+
+    def _isdir(self, path):
+        self._instr.count('stat')
+        return os.path.isdir(path)
 
     def _rename(self, path_from, path_to):
+        self._instr.count('rename')
         os.rename(path_from, path_to)
         self._renamed.append((path_from, path_to))
 
@@ -387,17 +1072,42 @@ class Renamer(object):
 
     def _ensure_parent_exists(self, path):
         parent = os.path.dirname(path)
-        if not os.path.exists(parent):
+        if not self._exists(parent):
             self._ensure_parent_exists(parent)
+            self._instr.count('mkdir')
             os.mkdir(parent)
-        self._created.append(path)
+            self._created.append(parent)
 
     @staticmethod
     def _ends_with_slash(path):
         return path.endswith('/') or path.endswith('\\')
 
+    def _report(self, force=False):
+        if self._progress is None:
+            return
+        now = time.time()
+        if not force and now - self._last_report < self.progress_interval:
+            return
+        self._last_report = now
+
+        done = 0
+        for count, total in reversed(self._position[1:]):
+            done = (count + done) / total
+        done += self._position[0][0]
+        total = self._position[0][1]
+        rate = done / max(now - self._start, 1e-6)
+        eta = (total - done) / rate if rate else None
+        self._progress(Progress(done, total, rate, eta))
+
     def _rename_mapping(self, mapping, overwrite, create_missing, delete_empty):
-        for name_from, name_to in mapping:
+        mapping = list(mapping)
+        self._position.append([0, len(mapping)])
+        for idx, (name_from, name_to) in enumerate(mapping):
+            self._position[-1][0] = idx
+            self._report(force=len(self._position) == 1 and idx == 0)
+            if self._cancel is not None and self._cancel.is_set():
+                raise RenameCancelled()
+
             path_from = os.path.join(self._root, name_from)
             path_to = os.path.join(self._root, name_to)
             dir_mapping = False
@@ -410,7 +1120,7 @@ class Renamer(object):
                 path_to = path_to[:-1]
                 dir_mapping = True
 
-            if dir_mapping and not os.path.isdir(path_from):
+            if dir_mapping and not self._isdir(path_from):
                 raise NotADirectoryError(path_from)
 
             if path_from == path_to:
@@ -423,64 +1133,498 @@ class Renamer(object):
             self._destinations.add(name_to)
 
             try:
-                if os.path.exists(path_to):
+                if self._exists(path_to):
                     raise FileExistsError(path_to)
                 if create_missing:
                     self._ensure_parent_exists(path_to)
                 self._rename(path_from, path_to)
             except FileExistsError:
-                if os.path.isdir(path_from):
-                    if not os.path.isdir(path_to):
+                if self._isdir(path_from):
+                    if not self._isdir(path_to):
                         raise NotADirectoryError(path_to)
+                    self._instr.count('listdir')
                     sub_mapping = ((os.path.join(name_from, name), os.path.join(name_to, name)) for name in os.listdir(path_from))
                     self._rename_mapping(sub_mapping, overwrite, create_missing, delete_empty)
                     self._delete(path_from)
                 elif not overwrite:
                     raise
                 else:
-                    if os.path.isdir(path_to):
+                    if self._isdir(path_to):
                         raise IsADirectoryError(path_to)
                     self._delete(path_to)
                     self._rename(path_from, path_to)
+        self._position.pop()
 
     def rename_mapping(self, mapping, overwrite, create_missing, delete_empty):
         self._renamed = []
         self._created = []
         self._temp = []
         self._destinations = set()
+        mapping = list(mapping)
         
         try:
-            self._rename_mapping(mapping, overwrite, create_missing, delete_empty)
+            with self._instr.phase('rename'):
+                self._position = []
+                self._start = self._last_report = time.time()
+                self._rename_mapping(mapping, overwrite, create_missing, delete_empty)
+                self._position = [[len(mapping), len(mapping)]]
+                self._report(force=True)
         except:
-            for done_from, done_to in reversed(self._renamed):
-                os.rename(done_to, done_from)
-            for path in reversed(self._created):
-                os.rmdir(path)
+            with self._instr.phase('rollback'):
+                for done_from, done_to in reversed(self._renamed):
+                    self._instr.count('rename')
+                    os.rename(done_to, done_from)
+                for path in reversed(self._created):
+                    self._instr.count('rmdir')
+                    os.rmdir(path)
             raise
         
-        for path in reversed(self._temp):
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            else:
-                os.remove(path)
-
-        parents = []
-        for path_from, path_to in reversed(self._renamed):
-            parents.append(os.path.dirname(path_from))
-        processed_parents = set()
-        for parent in parents:
-            if parent not in processed_parents:
-                if os.path.isdir(parent) and not os.listdir(parent):
-                    os.rmdir(parent)
-                processed_parents.add(parent)
+        with self._instr.phase('cleanup'):
+            for path in reversed(self._temp):
+                if self._isdir(path):
+                    self._instr.count('rmtree')
+                    shutil.rmtree(path)
+                else:
+                    self._instr.count('remove')
+                    os.remove(path)
+
+            parents = []
+            for path_from, path_to in reversed(self._renamed):
+                parents.append(os.path.dirname(path_from))
+            processed_parents = set()
+            for parent in parents:
+                if parent not in processed_parents:
+                    if self._isdir(parent):
+                        self._instr.count('listdir')
+                        if not os.listdir(parent):
+                            self._instr.count('rmdir')
+                            os.rmdir(parent)
+                    processed_parents.add(parent)
             
         self._renamed = None
         self._created = None
         self._temp = None
         self._destinations = None
+        self._position = None
+
+def rename(root, mapping, overwrite=False, create_missing=False, delete_empty=False,
+           progress=None, cancel=None, profile=False, instr=None):
+    """Rename entries under root, returns the Instrumentation of the run.
+
+    Its report() holds per-phase wall time and operation counts, json()
+    the same as a JSON document.  If the rename fails or is cancelled,
+    the raised exception carries it as its instrumentation attribute.
+    """
+    instr = instr or Instrumentation(profile)
+    try:
+        Renamer(root, progress, cancel, instr).rename_mapping(mapping, overwrite, create_missing, delete_empty)
+    except Exception as e:
+        e.instrumentation = instr
+        raise
+    return instr
+
+class LocalBackend(object):
+    """Scans, previews and renames in this process."""
+
+    def __init__(self, profile=False):
+        self._profile = profile
+        self._names = []
+        self._types = None
+
+    def scan(self, root, recursive, refresh=False):
+        instr = Instrumentation(self._profile)
+        self._names = scan(root, recursive, instr) if root else []
+        self._types = None
+        return instr
+
+    def preview(self, root, recursive, regex, repl, options, sample=None):
+        instr = Instrumentation(self._profile)
+        names = self._names
+        if sample is None:
+            preview = compute_preview(root, names, recursive, regex, repl, options, instr)
+        else:
+            if self._types is None:
+                self._types = dict(names)
+            preview = estimate_preview(root, names, recursive, regex, repl, options,
+                                       sample, self._types, instr)
+        return preview, instr
+
+    def rename(self, root, mapping, overwrite=False, create_missing=False, delete_empty=False,
+               progress=None, cancel=None):
+        return rename(root, mapping, overwrite, create_missing, delete_empty,
+                      progress, cancel, self._profile)
+
+
+class ServiceError(Exception):
+    pass
+
+
+class _Connection(object):
+    # newline separated JSON messages over a stream socket
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = bytearray()
+        self._scanned = 0
+
+    def close(self):
+        self._sock.close()
+
+    def send(self, message):
+        self._sock.sendall(json.dumps(message).encode('utf8') + b'\n')
+
+    def receive(self, timeout=None):
+        self._sock.settimeout(timeout)
+        while True:
+            idx = self._buffer.find(b'\n', self._scanned)
+            if idx >= 0:
+                line = bytes(self._buffer[:idx])
+                del self._buffer[:idx+1]
+                self._scanned = 0
+                return json.loads(line.decode('utf8'))
+            self._scanned = len(self._buffer)
+            data = self._sock.recv(1 << 16)
+            if not data:
+                raise EOFError('Connection closed')
+            self._buffer += data
+
+
+def _overlaps(root, other):
+    return root == other or root.startswith(other + os.sep) or other.startswith(root + os.sep)
+
+def _within(path, root):
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+class Service(object):
+    """Shared scanned index of roots serving previews and renames.
+
+    Every (root, recursive) pair is scanned once and kept until it is
+    refreshed.  Renames in overlapping roots are serialized, once one
+    succeeds only the entries of its mapping are scanned again in every
+    indexed root it overlaps with.
+
+    If roots is given, only directories within one of them are served
+    and every entry of a rename mapping has to stay within its root.
+    """
+
+    def __init__(self, roots=None):
+        self._roots = None if roots is None else [os.path.realpath(root) for root in roots]
+        self._lock = threading.Lock()
+        self._index = {}
+        self._types = {}
+        self._scan_locks = {}
+        self._batches = threading.Condition()
+        self._active = set()
+        self._cancels = {}
+        self._batch_ids = itertools.count(1)
+
+    @staticmethod
+    def _key(root, recursive):
+        return os.path.realpath(root), bool(recursive)
+
+    def _check_root(self, root):
+        real_root = os.path.realpath(root)
+        if self._roots is not None and not any(_within(real_root, allowed) for allowed in self._roots):
+            raise ServiceError('Root is not served: %s' % root)
+        return real_root
+
+    @staticmethod
+    def _check_mapping(real_root, mapping):
+        # the entry itself may be a symlink, only its parent is resolved
+        for names in mapping:
+            for name in names:
+                path = os.path.normpath(os.path.join(real_root, name))
+                path = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+                if path == real_root or not _within(path, real_root):
+                    raise ServiceError('Name is outside of root: %s' % name)
+
+    def _scan(self, root, recursive, refresh):
+        self._check_root(root)
+        key = self._key(root, recursive)
+        with self._lock:
+            scan_lock = self._scan_locks.setdefault(key, threading.Lock())
+        with scan_lock:
+            with self._lock:
+                names = self._index.get(key)
+            instr = Instrumentation()
+            if names is None or refresh:
+                names = scan(root, recursive, instr)
+                with self._lock:
+                    self._index[key] = names
+                    self._types.pop(key, None)
+        return names, instr
+
+    def _update(self, key, paths, instr):
+        path, recursive = key
+        with self._lock:
+            scan_lock = self._scan_locks.setdefault(key, threading.Lock())
+        with scan_lock:
+            with self._lock:
+                names = self._index.get(key)
+            if names is None:
+                return
+            if any(_within(path, other) for other in paths):
+                # the indexed root is within the changes
+                names = scan(path, recursive, instr) if os.path.isdir(path) else None
+            else:
+                changed = [os.path.relpath(other, path) for other in paths if _within(other, path)]
+                names = _rescan(path, names, recursive, changed, instr)
+            with self._lock:
+                if names is None:
+                    del self._index[key]
+                else:
+                    self._index[key] = names
+                self._types.pop(key, None)
+
+    def scan(self, root, recursive, refresh=False):
+        _, instr = self._scan(root, recursive, refresh)
+        return instr
+
+    def preview(self, root, recursive, regex, repl, options, sample=None):
+        names, _ = self._scan(root, recursive, False)
+        instr = Instrumentation()
+        if sample is None:
+            return compute_preview(root, names, recursive, regex, repl, options, instr), instr
+
+        key = self._key(root, recursive)
+        with self._lock:
+            types = self._types.get(key)
+        if types is None:
+            types = dict(names)
+            with self._lock:
+                if self._index.get(key) is names:
+                    self._types[key] = types
+        preview = estimate_preview(root, names, recursive, regex, repl, options, sample, types, instr)
+        return preview, instr
+
+    def new_batch(self):
+        with self._lock:
+            batch = next(self._batch_ids)
+            self._cancels[batch] = threading.Event()
+        return batch
+
+    def cancel(self, batch):
+        with self._lock:
+            cancel = self._cancels.get(batch)
+        if cancel is not None:
+            cancel.set()
+
+    @contextmanager
+    def _batch(self, root):
+        with self._batches:
+            while any(_overlaps(root, other) for other in self._active):
+                self._batches.wait()
+            self._active.add(root)
+        try:
+            yield
+        finally:
+            with self._batches:
+                self._active.remove(root)
+                self._batches.notify_all()
+
+    def rename(self, batch, root, mapping, overwrite=False, create_missing=False, delete_empty=False,
+               progress=None):
+        real_root = self._check_root(root)
+        self._check_mapping(real_root, mapping)
+        with self._lock:
+            cancel = self._cancels[batch]
+        try:
+            with self._batch(real_root):
+                # a failed rename is rolled back, the index stays valid
+                instr = rename(root, mapping, overwrite, create_missing, delete_empty, progress, cancel)
+                paths = set(os.path.normpath(os.path.join(real_root, name))
+                            for names in mapping for name in names)
+                with self._lock:
+                    stale = [key for key in self._index if _overlaps(real_root, key[0])]
+                for key in stale:
+                    self._update(key, paths, instr)
+                return instr
+        finally:
+            with self._lock:
+                del self._cancels[batch]
+
+
+class _ServiceHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        connection = _Connection(self.request)
+        try:
+            request = connection.receive()
+            op = request.pop('op')
+            if op not in ('scan', 'preview', 'rename', 'cancel'):
+                raise ServiceError('Unknown operation: %s' % op)
+            getattr(self, '_handle_' + op)(connection, self.server.service, **request)
+        except EOFError:
+            pass
+        except Exception as e:
+            self._send_error(connection, e)
+
+    @staticmethod
+    def _send_error(connection, error):
+        response = dict(error=str(error), type=type(error).__name__)
+        instr = getattr(error, 'instrumentation', None)
+        if instr is not None:
+            response['report'] = instr.report()
+        try:
+            connection.send(response)
+        except OSError:
+            pass
+
+    def _handle_scan(self, connection, service, root, recursive, refresh):
+        instr = service.scan(root, recursive, refresh)
+        connection.send(dict(report=instr.report()))
+
+    def _handle_preview(self, connection, service, root, recursive, regex, repl, options, sample=None):
+        regex = re.compile(regex) if regex is not None else None
+        preview, instr = service.preview(root, recursive, regex, repl, Options(**options), sample)
+        connection.send(dict(preview=preview._asdict(), report=instr.report()))
+
+    def _handle_rename(self, connection, service, root, mapping, overwrite, create_missing, delete_empty):
+        batch = service.new_batch()
+        connection.send(dict(batch=batch))
+        instr = service.rename(batch, root, mapping, overwrite, create_missing, delete_empty,
+                               lambda progress: connection.send(dict(progress=progress)))
+        connection.send(dict(report=instr.report()))
+
+    def _handle_cancel(self, connection, service, batch):
+        service.cancel(batch)
+        connection.send(dict())
+
+
+def _bind(path, mode):
+    base_class = getattr(socketserver, 'ThreadingUnixStreamServer', None)
+    if base_class is None:
+        raise ServiceError('Unix domain sockets are not supported on this platform')
+
+    class server_class(base_class):
+        daemon_threads = True
+
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise ServiceError('Not a socket: %s' % path)
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except OSError:
+            os.remove(path)
+        else:
+            raise ServiceError('Service is already running: %s' % path)
+        finally:
+            probe.close()
+
+    # nobody but the owner may connect before the mode is applied
+    umask = os.umask(0o177)
+    try:
+        server = server_class(path, _ServiceHandler)
+    finally:
+        os.umask(umask)
+    try:
+        os.chmod(path, mode)
+    except OSError:
+        server.server_close()
+        os.remove(path)
+        raise
+    return server
+
+def serve(path, roots=None, mode=0o600):
+    """Run a Service on a Unix domain socket until interrupted.
+
+    Anyone who can connect to the socket can rename within the served
+    roots as the user running the service, so the socket is created with
+    the given mode (owner only by default) regardless of the umask, and
+    roots limits the directories it serves (see Service).
+    """
+    with _bind(path, mode) as server:
+        server.service = Service(roots)
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+class Client(object):
+    """Thin client of a Service on a Unix domain socket, same API as LocalBackend."""
+
+    poll_interval = 0.1
+
+    def __init__(self, path):
+        self._path = path
+
+    def _connect(self, **request):
+        sock = socket.socket(socket.AF_UNIX)
+        try:
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            raise
+        connection = _Connection(sock)
+        connection.send(request)
+        return connection
+
+    @staticmethod
+    def _check(response):
+        if 'error' in response:
+            etype = globals().get(response['type']) or getattr(builtins, response['type'], None)
+            if not isinstance(etype, type) or not issubclass(etype, Exception):
+                etype = ServiceError
+            error = etype(response['error'])
+            if 'report' in response:
+                error.instrumentation = Instrumentation.from_report(response['report'])
+            raise error
+        return response
+
+    def _request(self, **request):
+        connection = self._connect(**request)
+        try:
+            return self._check(connection.receive())
+        finally:
+            connection.close()
+
+    def scan(self, root, recursive, refresh=False):
+        if not root:
+            return Instrumentation()
+        response = self._request(op='scan', root=root, recursive=recursive, refresh=refresh)
+        return Instrumentation.from_report(response['report'])
+
+    def preview(self, root, recursive, regex, repl, options, sample=None):
+        if not root:
+            return compute_preview(root, [], recursive, regex, repl, options), Instrumentation()
+        response = self._request(
+            op='preview', root=root, recursive=recursive,
+            regex=regex.pattern if regex else None, repl=repl, options=options._asdict(),
+            sample=sample,
+        )
+        preview = Preview(**response['preview'])
+        preview = preview._replace(
+            rows=[Row(*row) for row in preview.rows],
+            mapping=[tuple(entry) for entry in preview.mapping],
+        )
+        return preview, Instrumentation.from_report(response['report'])
 
-def rename(root, mapping, overwrite=False, create_missing=False, delete_empty=False):
-    Renamer(root).rename_mapping(mapping, overwrite, create_missing, delete_empty)
+    def rename(self, root, mapping, overwrite=False, create_missing=False, delete_empty=False,
+               progress=None, cancel=None):
+        connection = self._connect(
+            op='rename', root=root, mapping=list(mapping),
+            overwrite=overwrite, create_missing=create_missing, delete_empty=delete_empty,
+        )
+        try:
+            batch = self._check(connection.receive())['batch']
+            cancelled = False
+            while True:
+                if cancel is not None and cancel.is_set() and not cancelled:
+                    cancelled = True
+                    self._request(op='cancel', batch=batch)
+                try:
+                    response = connection.receive(self.poll_interval)
+                except socket.timeout:
+                    continue
+                self._check(response)
+                if 'progress' in response:
+                    if progress is not None:
+                        progress(Progress(*response['progress']))
+                else:
+                    return Instrumentation.from_report(response['report'])
+        finally:
+            connection.close()
 
 def show_error(self, et, ev, tb):
     for line in traceback.format_exception(et, ev, tb):
@@ -489,7 +1633,7 @@ def show_error(self, et, ev, tb):
     err = traceback.format_exception_only(et, ev)
     showerror('Exception', ''.join(err))
 
-def main():
+def main(profile=False, service=None):
     Tk.report_callback_exception = show_error
     master = Tk()
     master.title('Regex mass rename')                    
@@ -503,12 +1647,67 @@ def main():
     options_frame = OptionsFrame(master)
     options_frame.pack(fill=X)
 
+    if service:
+        backend = Client(service)
+    else:
+        backend = LocalBackend(profile)
+
     list_frame = ListFrame(master,
                            root_frame.root, root_frame.recursive,
                            regex_frame.regex, regex_frame.repl,
-                           options_frame.options)
+                           options_frame.options, backend)
     list_frame.pack(fill=BOTH, expand=True)
 
+    def dump_profile(instr):
+        if profile and instr is not None:
+            sys.stderr.write(instr.report().get('profile', ''))
+
+    def update_stats(event=None):
+        instrumentation = list_frame.instrumentation + tuple(last_rename)
+        summaries = (instr.summary() for instr in instrumentation)
+        status_bar.config(text='; '.join(summary for summary in summaries if summary))
+
+    def on_stats_update(event):
+        # a preview is refreshed far more often than the scan it is based on
+        for instr in list_frame.instrumentation:
+            if instr is not None and all(instr is not other for other in dumped):
+                dump_profile(instr)
+        dumped[:] = list_frame.instrumentation
+        update_stats()
+
+    last_rename = []
+    dumped = []
+    master.bind('<<StatsUpdate>>', on_stats_update)
+
+    def update_rename_button():
+        if list_frame.exact and not progress_frame.running:
+            rename_button.config(state=NORMAL)
+        else:
+            rename_button.config(state=DISABLED)
+
+    def on_preview_update(event):
+        summary_label.config(text=list_frame.summary)
+        update_rename_button()
+
+    master.bind('<<PreviewUpdate>>', on_preview_update)
+
+    def rename_done(instr, error):
+        update_rename_button()
+        if isinstance(error, RenameCancelled):
+            showinfo('Cancelled', 'Rename cancelled, all changes were rolled back')
+        elif error is not None:
+            show_error(None, type(error), error, error.__traceback__)
+        if error is not None:
+            instr = getattr(error, 'instrumentation', None)
+        if instr is not None:
+            last_rename[:] = [instr]
+            dump_profile(instr)
+            update_stats()
+        if closing:
+            master.destroy()
+        else:
+            master.event_generate('<<Renamed>>', when='tail')
+
     def perform_rename(*args):
         errors = list_frame.errors
         if len(errors) > 20:
@@ -518,16 +1717,60 @@ def main():
         elif not list_frame.mapping:
             showerror('Error', 'Nothing to rename')
         else:
-            rename(root_frame.root, list_frame.mapping, options_frame.options.overwrite)
-            master.event_generate('<<Refresh>>', when='tail')
+            root = root_frame.root
+            mapping = list_frame.mapping
+            options = options_frame.options
+            rename_button.config(state=DISABLED)
+            progress_frame.run(
+                lambda progress, cancel: backend.rename(
+                    root, mapping,
+                    options.overwrite, options.create_missing, options.delete_empty,
+                    progress, cancel),
+                rename_done)
+
+    def close(*args):
+        if progress_frame.running:
+            closing.append(True)
+            progress_frame.cancel()
+        else:
+            master.destroy()
+
+    closing = []
+    master.protocol('WM_DELETE_WINDOW', close)
+
+    summary_label = Label(master, anchor='w')
+    summary_label.pack(fill=X)
 
     rename_button = Button(master, text='Rename', command=perform_rename)
     rename_button.pack()
 
+    progress_frame = ProgressFrame(master)
+    progress_frame.pack(fill=X)
+
+    status_bar = Label(master, anchor='w', relief=SUNKEN)
+    status_bar.pack(fill=X)
+
     repad(master, 'pady', 5, 5, 'padx', 5)
 
     master.mainloop()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Regex mass rename')
+    parser.add_argument('--profile', action='store_true',
+                        help='dump cProfile output of every phase to stderr')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='run the shared index service on a Unix domain socket')
+    parser.add_argument('--connect', metavar='SOCKET',
+                        help='scan, preview and rename through the service on SOCKET')
+    parser.add_argument('--root', metavar='DIR', action='append',
+                        help='directory the service may scan and rename in, can be repeated')
+    parser.add_argument('--mode', type=lambda mode: int(mode, 8), default=0o600,
+                        help='permissions of the service socket (default: 600)')
+    args = parser.parse_args()
+    if args.serve:
+        if not args.root:
+            parser.error('--serve requires at least one --root')
+        serve(args.serve, args.root, args.mode)
+    else:
+        main(args.profile, args.connect)
@@ -1,6 +1,11 @@
 import os
 import unittest
+import threading
+import json
+from unittest import mock
 import tempfile
+import re
+import socket
 
 import rerename
 
@@ -41,6 +46,13 @@ def walk(root_path):
                 rel_path = os.path.relpath(path, root_path)
                 yield rel_path.replace('\\', '/') + '/', None
 
+def scan(root_path):
+    for root, dirs, files in os.walk(root_path):
+        for name in files:
+            yield os.path.relpath(os.path.join(root, name), root_path), True
+        for name in dirs:
+            yield os.path.relpath(os.path.join(root, name), root_path), False
+
 def iterslash(desc):
     if '?' not in desc:
         yield desc
@@ -259,6 +271,127 @@ class RenameTest(unittest.TestCase):
             d/
         ''', delete_empty=True)
 
+    def test_progress(self):
+        self.create('''
+            a
+            b
+            c
+        ''')
+        events = []
+        rerename.rename(self.root, parse('''
+            a = 1
+            b = 2
+            c = x/3
+        '''), create_missing=True, progress=events.append)
+        self.check('''
+            1 = a
+            2 = b
+            x/3 = c
+        ''')
+        self.assertEqual(events[-1][:2], (3, 3))
+        self.assertEqual(events[-1].eta, 0)
+
+    def test_progress_merge(self):
+        self.create('''
+            a/a1
+            a/a2
+            a/a3
+            a/a4
+            b/
+            c
+        ''')
+        events = []
+        with mock.patch.object(rerename.Renamer, 'progress_interval', 0):
+            rerename.rename(self.root, parse('''
+                a = b
+                c = d
+            '''), progress=events.append)
+        done = [event.done for event in events]
+        self.assertEqual(done[0], 0)
+        self.assertIsNone(events[0].eta)
+        # the merge of a into b advances a quarter entry per file
+        self.assertEqual(done[1:5], [0, 0.25, 0.5, 0.75])
+        self.assertEqual(done[-1], 2)
+
+    def test_report(self):
+        self.create('''
+            a
+            b/b1
+            c
+            e
+            f
+        ''')
+        instr = rerename.rename(self.root, parse('''
+            a = x/a
+            c = d
+            b/ = c/
+            e = f
+        '''), overwrite=True, create_missing=True, profile=True)
+        report = json.loads(instr.json())
+        self.assertEqual(set(report['phases']), {'rename', 'cleanup'})
+        self.assertEqual(report['counts']['rename'], 5)
+        self.assertEqual(report['counts']['mkdir'], 1)
+        self.assertEqual(report['counts']['remove'], 1)
+        self.assertIn('rename_mapping', report['profile'])
+
+    def test_report_unprofiled(self):
+        report = rerename.Instrumentation(True).report()
+        self.assertNotIn('profile', report)
+
+    def test_report_concurrent_profiles(self):
+        first = rerename.Instrumentation(True)
+        second = rerename.Instrumentation(True)
+        def run():
+            with second.phase('preview'):
+                pass
+        with first.phase('preview'):
+            thread = threading.Thread(target=run)
+            thread.start()
+            thread.join()
+        self.assertIn('preview', second.phases)
+        self.assertNotIn('profile', second.report())
+        with second.phase('rename'):
+            pass
+        self.assertIn('profile', first.report())
+        self.assertIn('profile', second.report())
+
+    def test_report_failure(self):
+        src = '''
+            a
+            b
+        '''
+        self.create(src)
+        instr = rerename.Instrumentation()
+        with self.assertRaises(FileNotFoundError) as cm:
+            rerename.rename(self.root, parse('''
+                a = c
+                x = y
+            '''), instr=instr)
+        self.check(src)
+        self.assertIs(cm.exception.instrumentation, instr)
+        report = instr.report()
+        self.assertIn('rollback', report['phases'])
+
+    def test_cancel(self):
+        src = '''
+            a
+            b
+            c/c1
+        '''
+        self.create(src)
+        cancel = threading.Event()
+        def progress(event):
+            if event.done == 2:
+                cancel.set()
+        with mock.patch.object(rerename.Renamer, 'progress_interval', 0):
+            with self.assertRaises(rerename.RenameCancelled):
+                rerename.rename(self.root, parse('''
+                    a = x/1
+                    c = y/c
+                    b = 2
+                '''), create_missing=True, progress=progress, cancel=cancel)
+        self.check(src)
+
     def test_fail_wrong_trailing_slash(self):
         self.create('a')
         with self.assertRaises(NotADirectoryError):
@@ -283,3 +416,381 @@ class RenameTest(unittest.TestCase):
                 rerename.rename(self.root, parse(subdesc), overwrite=True)
             self.check(src)
             
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_obj = tempfile.TemporaryDirectory()
+        self.root = self.root_obj.name
+        create(self.root, '''
+            a
+            b
+            d/d1
+            e/
+        ''')
+
+    def tearDown(self):
+        self.root_obj.cleanup()
+
+    def validate(self, mapping, recursive, **kwargs):
+        if recursive:
+            names = list(scan(self.root))
+        else:
+            names = [(name, os.path.isfile(os.path.join(self.root, name))) for name in os.listdir(self.root)]
+        conflicts = rerename.validate_mapping(self.root, names, mapping, recursive, **kwargs)
+        return [conflict.message for conflict in conflicts]
+
+    def test_all_conflicts(self):
+        for recursive in (True, False):
+            self.assertEqual(self.validate([
+                ('a', 'e'),
+                ('b', 'd/d1'),
+                ('d', 'x/d'),
+                ('e', 'a/e'),
+            ], recursive, overwrite=True), [
+                'Is a directory: e',
+                'Missing directory: x',
+                'Not a directory: a',
+            ])
+
+    def test_matches_renamer(self):
+        # the validator reports conflicts exactly when rename() fails
+        cases = [
+            ('a = 1', {}),
+            ('a = b', {}),
+            ('a = b', dict(overwrite=True)),
+            ('a = e', dict(overwrite=True)),
+            ('a = x/a', {}),
+            ('a = x/a', dict(create_missing=True)),
+            ('a = b/x', dict(create_missing=True)),
+            ('a/ = 1', {}),
+            ('a = 1/', {}),
+            ('b = 1\n c =', {}),
+            ('a = 1\n b = 1', dict(overwrite=True)),
+            ('d? = e?', {}),
+            ('d? = a?', dict(overwrite=True)),
+            ('e? = d/x?', {}),
+            ('missing = x', {}),
+            ('missing? = missing?', {}),
+        ]
+        for idx, (desc, kwargs) in enumerate(cases):
+            for subidx, subdesc in enumerate(iterslash(desc)):
+                with self.subTest(desc=subdesc, **kwargs):
+                    root = os.path.join(self.root, 'case%d_%d' % (idx, subidx))
+                    os.mkdir(root)
+                    create(root, '''
+                        a
+                        b
+                        d/d1
+                        e/
+                    ''')
+                    conflicts = rerename.validate_mapping(root, list(scan(root)), parse(subdesc), True, **kwargs)
+                    try:
+                        rerename.rename(root, parse(subdesc), **kwargs)
+                    except Exception:
+                        self.assertTrue(conflicts)
+                    else:
+                        self.assertEqual(conflicts, [])
+
+    def test_merge(self):
+        for recursive in (True, False):
+            self.assertEqual(self.validate([
+                ('d/d1', 'e/d1'),
+                ('a', 'e/d1'),
+                ('b', 'e/b'),
+                ('d', 'e'),
+            ], recursive), [
+                'Name collision: e/d1 <- a | d/d1',
+            ])
+            self.assertEqual(self.validate([
+                ('a', 'b'),
+                ('d/d1', 'e/d1'),
+                ('e', 'd'),
+            ], recursive, overwrite=True), [])
+
+
+class PreviewTest(unittest.TestCase):
+
+    def test_collapsed_conflict_rows(self):
+        names = [
+            ('old', False),
+            (os.path.join('old', 'a'), True),
+            (os.path.join('old', 'sub'), False),
+            (os.path.join('old', 'sub', 'b'), True),
+            ('x', True),
+        ]
+        preview = rerename.compute_preview(None, names, True, re.compile(r'^old/(.*)$'), r'x/new/\1', rerename.DEFAULT_OPTIONS)
+        self.assertEqual(preview.mapping, [('old', os.path.join('x', 'new'))])
+        self.assertEqual(preview.errors, ['Not a directory: x'])
+        self.assertEqual([row.right_color for row in preview.rows], ['gray', 'red', 'gray', 'red', 'gray'])
+
+
+class CollapseTest(unittest.TestCase):
+
+    def collapse(self, names, mapping, create_missing=True):
+        names = [(name.replace('/', os.sep), ftype) for name, ftype in names]
+        mapping = [tuple(name.replace('/', os.sep) for name in entry) for entry in mapping]
+        res = rerename.collapse_mapping(names, mapping, create_missing)
+        return [tuple(name.replace(os.sep, '/') for name in entry) for entry in res]
+
+    def test_whole_tree(self):
+        names = [
+            ('old', False),
+            ('old/a', True),
+            ('old/sub', False),
+            ('old/sub/b', True),
+            ('other', True),
+        ]
+        mapping = [
+            ('old/a', 'new/a'),
+            ('old/sub/b', 'new/sub/b'),
+            ('other', 'other2'),
+        ]
+        self.assertEqual(self.collapse(names, mapping), [
+            ('old', 'new'),
+            ('other', 'other2'),
+        ])
+        self.assertEqual(self.collapse(names, mapping, create_missing=False), mapping)
+
+    def test_partial_tree(self):
+        names = [
+            ('old', False),
+            ('old/a', True),
+            ('old/keep', True),
+            ('old/sub', False),
+            ('old/sub/b', True),
+            ('old/sub/c', True),
+        ]
+        mapping = [
+            ('old/a', 'new/a'),
+            ('old/sub/b', 'new/sub/b'),
+            ('old/sub/c', 'new/sub/c'),
+        ]
+        self.assertEqual(self.collapse(names, mapping), [
+            ('old/a', 'new/a'),
+            ('old/sub', 'new/sub'),
+        ])
+
+    def test_no_collapse(self):
+        names = [
+            ('old', False),
+            ('old/a', True),
+            ('old/b', True),
+            ('old/empty', False),
+            ('new', False),
+            ('x', False),
+            ('x/a', True),
+            ('y', False),
+            ('y/a', True),
+        ]
+        mapping = [
+            ('old/a', 'new/a'),
+            ('old/b', 'new/b'),
+            ('x/a', 'z/a'),
+            ('y/a', 'x/y'),
+        ]
+        # old has an unmapped empty dir, x receives an entry
+        self.assertEqual(self.collapse(names, mapping), mapping)
+        names.remove(('old/empty', False))
+        # new already exists
+        self.assertEqual(self.collapse(names, mapping), mapping)
+
+        # only one of the directories merging into n is renamed to it
+        names = [
+            ('a', False),
+            ('a/x', True),
+            ('b', False),
+            ('b/y', True),
+        ]
+        mapping = [
+            ('a/x', 'n/x'),
+            ('b/y', 'n/y'),
+        ]
+        collapsed = self.collapse(names, mapping)
+        self.assertEqual(collapsed, [
+            ('a', 'n'),
+            ('b/y', 'n/y'),
+        ])
+        self.assertEqual(rerename.validate_mapping(None, names, collapsed, True, create_missing=True), [])
+
+    def test_rename(self):
+        root_obj = tempfile.TemporaryDirectory()
+        root = root_obj.name
+        try:
+            create(root, '''
+                old/a
+                old/sub/b
+                other
+            ''')
+            names = [
+                (os.path.relpath(os.path.join(path, name), root), None)
+                for path, dirs, files in os.walk(root)
+                for name in dirs + files
+            ]
+            mapping = [
+                (os.path.join('old', 'a'), os.path.join('new', 'a')),
+                (os.path.join('old', 'sub', 'b'), os.path.join('new', 'sub', 'b')),
+            ]
+            mapping = rerename.collapse_mapping(names, mapping, True)
+            self.assertEqual(mapping, [('old', 'new')])
+            rerename.rename(root, mapping, create_missing=True)
+            self.assertEqual(dict(walk(root)), {
+                'new/a': 'a',
+                'new/sub/b': 'b',
+                'other': 'other',
+            })
+        finally:
+            root_obj.cleanup()
+
+class EstimateTest(unittest.TestCase):
+
+    options = rerename.DEFAULT_OPTIONS._replace(create_missing=False)
+
+    def setUp(self):
+        self.names = [('f%04d' % idx, True) for idx in range(10000)]
+
+    def estimate(self, regex, repl, size=100, types=None, block=8):
+        return rerename.estimate_preview(None, self.names, True, re.compile(regex), repl,
+                                         self.options, size, types, block=block)
+
+    def test_matches(self):
+        preview = self.estimate(r'^f0(\d+)$', r'g\1', size=800)
+        self.assertFalse(preview.exact)
+        self.assertEqual(len(preview.rows), 800)
+        self.assertEqual(preview.matches, 1000)
+        self.assertEqual(preview.conflicts, 0)
+
+        preview = self.estimate(r'^f0(\d+)$', r'g\1', size=10000)
+        self.assertTrue(preview.exact)
+        self.assertEqual(preview.matches, 1000)
+
+    def test_conflicts(self):
+        # targets exist, but are rarely sampled themselves
+        preview = self.estimate(r'^f(\d)(\d+)$', r'f\2\1')
+        self.assertLess(preview.conflicts, 1000)
+        preview = self.estimate(r'^f(\d)(\d+)$', r'f\2\1', types=dict(self.names))
+        self.assertAlmostEqual(preview.conflicts, 10000, delta=300)
+
+    def test_collisions(self):
+        self.names = sorted([('a%04d' % idx, True) for idx in range(5000)] +
+                            [('b%04d' % idx, True) for idx in range(5000)])
+        preview = self.estimate(r'^[ab](\d+)$', r'c\1', size=5000)
+        self.assertAlmostEqual(preview.conflicts, 5000, delta=500)
+
+    def test_adjacent_collisions(self):
+        # colliding names are neighbours once sorted
+        self.names = [('x%04d_%d' % (idx // 2, idx % 2), True) for idx in range(10000)]
+        preview = self.estimate(r'^(.*)_\d$', r'\1', size=1000)
+        self.assertTrue(preview.errors)
+        self.assertAlmostEqual(preview.conflicts, 5000, delta=500)
+        preview = self.estimate(r'^(.*)_\d$', r'\1', size=1000, block=1)
+        self.assertEqual(preview.conflicts, 0)
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix domain sockets')
+class ServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root_obj = tempfile.TemporaryDirectory()
+        self.root = self.root_obj.name
+        create(self.root, '''
+            a1
+            b/b1
+        ''')
+        self.socket_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.socket_dir.name, 'service.sock')
+        self.server = rerename._bind(path, 0o600)
+        self.server.service = rerename.Service([self.root])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = rerename.Client(path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.socket_dir.cleanup()
+        self.root_obj.cleanup()
+
+    def preview(self):
+        preview, _ = self.client.preview(self.root, True, re.compile(r'^(.*)1$'), r'\g<1>2', rerename.DEFAULT_OPTIONS)
+        return preview
+
+    def test_preview_rename(self):
+        preview = self.preview()
+        self.assertEqual(preview.errors, [])
+        self.assertEqual(preview.mapping, [('a1', 'a2'), (os.path.join('b', 'b1'), os.path.join('b', 'b2'))])
+
+        instr = self.client.rename(self.root, preview.mapping)
+        self.assertEqual(instr.counts['rename'], 2)
+        preview = self.preview()
+        self.assertEqual(preview.mapping, [])
+        self.assertEqual([row.left for row in preview.rows], ['a2', 'b', os.path.join('b', 'b2')])
+
+    def test_index_update(self):
+        create(self.root, '''
+            d/d1
+            d/sub/d2
+            e/d1
+            e/e1
+            g/g1
+            h
+        ''')
+        service = self.server.service
+        keys = [(self.root, True), (self.root, False), (os.path.join(self.root, 'g'), True),
+                (os.path.join(self.root, 'e'), True)]
+        for root, recursive in keys:
+            self.client.scan(root, recursive)
+        renames = [
+            [('d/', 'e/'), ('h', 'x/y/h'), ('a1', 'e/e1')],
+            [('g', 'x/g'), ('b/b1', 'b1')],
+            [('x/y/h', 'h'), ('missing', 'irrelevant')],
+        ]
+        scan = rerename.scan
+        with mock.patch('rerename.scan', wraps=scan) as scan_mock:
+            for mapping in renames:
+                mapping = [tuple(name.replace('/', os.sep) for name in entry) for entry in mapping]
+                try:
+                    self.client.rename(self.root, mapping, overwrite=True, create_missing=True)
+                except FileNotFoundError:
+                    pass
+                for root, recursive in keys:
+                    key = service._key(root, recursive)
+                    if os.path.isdir(root):
+                        with self.subTest(mapping=mapping, root=root, recursive=recursive):
+                            self.assertEqual(service._index[key], scan(root, recursive))
+                    else:
+                        self.assertNotIn(key, service._index)
+        # only the changed subtrees are scanned again
+        self.assertNotIn(self.root, [call.args[0] for call in scan_mock.call_args_list])
+
+    def test_roots(self):
+        with self.assertRaises(rerename.ServiceError):
+            self.client.scan(self.socket_dir.name, True)
+        self.client.scan(os.path.join(self.root, 'b'), True)
+        for mapping in ([('a1', '../a1')], [('a1', os.path.join(self.socket_dir.name, 'a1'))],
+                        [('b/..', 'c')]):
+            with self.subTest(mapping=mapping):
+                with self.assertRaises(rerename.ServiceError):
+                    self.client.rename(self.root, mapping)
+        self.assertEqual(self.preview().mapping[0], ('a1', 'a2'))
+
+    def test_socket(self):
+        path = self.server.server_address
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        # a running service is not replaced, a file that is not a socket is not removed
+        with self.assertRaises(rerename.ServiceError):
+            rerename._bind(path, 0o600)
+        path = os.path.join(self.socket_dir.name, 'file')
+        create(self.socket_dir.name, 'file')
+        with self.assertRaises(rerename.ServiceError):
+            rerename._bind(path, 0o600)
+        self.assertTrue(os.path.isfile(path))
+        path = os.path.join(self.socket_dir.name, 'group.sock')
+        with rerename._bind(path, 0o660):
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o660)
+
+    def test_errors(self):
+        with self.assertRaises(FileNotFoundError):
+            self.client.rename(self.root, [('a1', 'c1'), ('missing', 'irrelevant')])
+        self.assertEqual(self.preview().mapping[0], ('a1', 'a2'))
+        with self.assertRaises(rerename.ServiceError):
+            self.client._request(op='unknown')